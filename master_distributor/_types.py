@@ -13,3 +13,6 @@ TupleFullDistributionAlias = tuple[str, str, str, int, float, str]
 FuncDistributeAlias = Callable[
     [list[TupleTradesAlias], list[TupleAllocationAlias]], list[TupleDistributionAlias]
 ]
+
+# Fraction of every price quantile that goes to each portfolio
+PatternAlias = dict[str, list[float]]
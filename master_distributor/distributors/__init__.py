@@ -1 +1,6 @@
-from .distributors import RandomLoopDistributor
+from .distributors import (
+    MinLinesDistributor,
+    RandomLoopDistributor,
+    TieredDistributor,
+    WeightedDistributor,
+)
@@ -31,6 +31,55 @@ def _get_trades_average_price(trades: list[TupleTradesAlias]) -> float:
     return total_volume / total_qty
 
 
+def _drop_exhausted_portfolios(
+    portfolios: list[str],
+    remaining_vertical_qty_per_portfolio: dict[str, int],
+) -> list[str]:
+    return [p for p in portfolios if remaining_vertical_qty_per_portfolio[p] > 0]
+
+
+class _ActivePortfolios:
+    """
+    Portfolios that can still receive quantity, in allocation order. A
+    portfolio is removed in O(1) as soon as it is filled, so loops over the
+    active portfolios never walk the filled ones again.
+    """
+
+    def __init__(self, portfolios: list[str]):
+        self.head: str | None = portfolios[0] if portfolios else None
+        self._next: dict[str, str | None] = dict(
+            zip(portfolios, [*portfolios[1:], None])
+        )
+        self._prev: dict[str, str | None] = dict(
+            zip(portfolios, [None, *portfolios[:-1]])
+        )
+
+    def __len__(self) -> int:
+        return len(self._next)
+
+    def __iter__(self):
+        # The next portfolio is read before yielding, so the current one
+        # can be removed while iterating.
+        portfolio = self.head
+        while portfolio is not None:
+            next_portfolio = self._next[portfolio]
+            yield portfolio
+            portfolio = next_portfolio
+
+    def next(self, portfolio: str) -> str | None:
+        return self._next[portfolio]
+
+    def remove(self, portfolio: str):
+        prev_portfolio = self._prev.pop(portfolio)
+        next_portfolio = self._next.pop(portfolio)
+        if prev_portfolio is None:
+            self.head = next_portfolio
+        else:
+            self._next[prev_portfolio] = next_portfolio
+        if next_portfolio is not None:
+            self._prev[next_portfolio] = prev_portfolio
+
+
 def _sort_by_average_price(orders: list[TupleTradesAlias]) -> list[TupleTradesAlias]:
     avg_price = _get_trades_average_price(orders)
     return sorted(orders, key=lambda x: abs(x[1] - avg_price))
@@ -56,36 +105,74 @@ def distribute_slice_weighted(
         k: v / total_qty for k, v in remaining_vertical_qty_per_portfolio.items()
     }
 
-    portfolios = tuple(remaining_vertical_qty_per_portfolio.keys())
+    active_portfolios = _ActivePortfolios(
+        list(remaining_vertical_qty_per_portfolio.keys())
+    )
 
     slice_distribution: list[TupleDistributionAlias] = []
 
     for order in orders:
         quantity = order[0]
         price = order[1]
-
-        remaining_order_qty = quantity
-        second_loop = False
+        if quantity <= 0:
+            continue
+
+        # The first active portfolio takes its weighted share of the order
+        first_portfolio: str = active_portfolios.head  # type: ignore
+        portfolio = active_portfolios.next(first_portfolio)
+        qty = int(weights[first_portfolio] * quantity)
+        qty = min(
+            max(qty, 1),
+            remaining_vertical_qty_per_portfolio[first_portfolio],
+        )
+        remaining_order_qty = quantity - qty
+        remaining_vertical_qty_per_portfolio[first_portfolio] -= qty
+        if remaining_vertical_qty_per_portfolio[first_portfolio] == 0:
+            active_portfolios.remove(first_portfolio)
+
+        slice_distribution.append((qty, price, first_portfolio))
+
+        # Then one unit for each of the following portfolios...
+        while remaining_order_qty > 0 and portfolio is not None:
+            next_portfolio = active_portfolios.next(portfolio)
+            remaining_order_qty -= 1
+            remaining_vertical_qty_per_portfolio[portfolio] -= 1
+            if remaining_vertical_qty_per_portfolio[portfolio] == 0:
+                active_portfolios.remove(portfolio)
+
+            slice_distribution.append((1, price, portfolio))
+            portfolio = next_portfolio
+
+        # ...and the rest is dealt one unit at a time, round robin. Full
+        # rounds are assigned in bulk instead of unit by unit, up to the
+        # first portfolio that gets filled.
         while remaining_order_qty > 0:
-            for portfolio in portfolios:
-                if remaining_order_qty == 0:
-                    break
-                max_qty_portfolio = remaining_vertical_qty_per_portfolio[portfolio]
-                if max_qty_portfolio == 0:
-                    continue
-
-                if second_loop:
-                    qty = 1
-                else:
-                    qty = int(weights[portfolio] * quantity)
-                    if qty == 0:
-                        qty = 1
-                    second_loop = True
-
-                remaining_order_qty -= qty
-                remaining_vertical_qty_per_portfolio[portfolio] -= qty
-
-                slice_distribution.append((qty, price, portfolio))
+            n_active = len(active_portfolios)
+            rounds = remaining_order_qty // n_active
+            if rounds == 0:
+                # Last partial round
+                for portfolio in active_portfolios:
+                    if remaining_order_qty == 0:
+                        break
+                    remaining_order_qty -= 1
+                    remaining_vertical_qty_per_portfolio[portfolio] -= 1
+                    if remaining_vertical_qty_per_portfolio[portfolio] == 0:
+                        active_portfolios.remove(portfolio)
+
+                    slice_distribution.append((1, price, portfolio))
+                break
+
+            rounds = min(
+                rounds,
+                min(remaining_vertical_qty_per_portfolio[p] for p in active_portfolios),
+            )
+            remaining_order_qty -= rounds * n_active
+            for portfolio in active_portfolios:
+                remaining_vertical_qty_per_portfolio[portfolio] -= rounds
+                if remaining_vertical_qty_per_portfolio[portfolio] == 0:
+                    active_portfolios.remove(portfolio)
+
+                slice_distribution.append((rounds, price, portfolio))
     return slice_distribution
 
 
@@ -99,8 +186,11 @@ def distribute_slice_random(
         random.shuffle(orders)
 
     remaining_vertical_qty_per_portfolio = _get_vertical_qty_per_portfolio(allocations)
+    remaining_total_qty = sum(remaining_vertical_qty_per_portfolio.values())
 
-    portfolios = tuple(remaining_vertical_qty_per_portfolio.keys())
+    active_portfolios = _ActivePortfolios(
+        list(remaining_vertical_qty_per_portfolio.keys())
+    )
 
     slice_distribution: list[TupleDistributionAlias] = []
 
@@ -110,20 +200,303 @@ def distribute_slice_random(
 
         remaining_order_qty = quantity
 
+        # When the order takes everything that is left, which is always the
+        # case for the last one, each portfolio gets its rest in bulk.
+        if remaining_order_qty >= remaining_total_qty:
+            for portfolio in active_portfolios:
+                qty = remaining_vertical_qty_per_portfolio[portfolio]
+                remaining_vertical_qty_per_portfolio[portfolio] = 0
+                active_portfolios.remove(portfolio)
+
+                slice_distribution.append((qty, price, portfolio))
+            remaining_total_qty = 0
+            continue
+
         while remaining_order_qty > 0:
-            for portfolio in portfolios:
+            for portfolio in active_portfolios:
                 if remaining_order_qty == 0:
                     break
                 max_qty_portfolio = remaining_vertical_qty_per_portfolio[portfolio]
-                if max_qty_portfolio == 0:
-                    continue
 
                 max_qty_random = min(max_qty_portfolio, remaining_order_qty)
                 qty = random.randint(1, max_qty_random)
 
                 remaining_order_qty -= qty
+                remaining_total_qty -= qty
                 remaining_vertical_qty_per_portfolio[portfolio] -= qty
+                if remaining_vertical_qty_per_portfolio[portfolio] == 0:
+                    active_portfolios.remove(portfolio)
 
                 slice_distribution.append((qty, price, portfolio))
 
     return slice_distribution
+
+
+def distribute_slice_pieces(
+    trades: list[TupleTradesAlias],
+    allocations: list[TupleAllocationAlias],
+    pieces_per_portfolio: int = 1,
+) -> list[TupleDistributionAlias]:
+    """
+    Splits every portfolio quantity into `pieces_per_portfolio` (near) equal
+    pieces and lays them, shuffled, one after the other over the shuffled
+    orders. The number of lines is at most `len(orders) + n_pieces - 1`,
+    so fewer pieces means fewer lines but a worse price fairness.
+    """
+    orders = list(trades)
+    random.shuffle(orders)
+
+    vertical_qty_per_portfolio = _get_vertical_qty_per_portfolio(allocations)
+
+    pieces: list[tuple[int, str]] = []
+    for portfolio, portfolio_qty in vertical_qty_per_portfolio.items():
+        n_pieces = min(pieces_per_portfolio, portfolio_qty)
+        cuts = [portfolio_qty * k // n_pieces for k in range(n_pieces + 1)]
+        for piece_start, piece_end in zip(cuts[:-1], cuts[1:]):
+            pieces.append((piece_end - piece_start, portfolio))
+    random.shuffle(pieces)
+
+    slice_distribution: list[TupleDistributionAlias] = []
+
+    piece_idx = 0
+    remaining_piece_qty = pieces[0][0]
+    for order in orders:
+        quantity = order[0]
+        price = order[1]
+
+        remaining_order_qty = quantity
+        while remaining_order_qty > 0:
+            portfolio = pieces[piece_idx][1]
+            qty = min(remaining_piece_qty, remaining_order_qty)
+
+            remaining_order_qty -= qty
+            remaining_piece_qty -= qty
+            if remaining_piece_qty == 0 and piece_idx + 1 < len(pieces):
+                piece_idx += 1
+                remaining_piece_qty = pieces[piece_idx][0]
+
+            slice_distribution.append((qty, price, portfolio))
+
+    return slice_distribution
+
+
+def distribute_slice_pattern(
+    trades: list[TupleTradesAlias],
+    allocations: list[TupleAllocationAlias],
+    target_qty_per_price: dict[float, list[tuple[str, float]]],
+    jitter: float = 0.0,
+) -> list[TupleDistributionAlias]:
+    """
+    Distributes each order following the target quantities of a warm-start
+    pattern (see `warm_start.pattern_target_qty`). Every target is scaled by
+    a random factor in `1 +- jitter`. Whatever the targets do not cover is
+    filled randomly.
+    """
+    orders = list(trades)
+    random.shuffle(orders)
+
+    remaining_vertical_qty_per_portfolio = _get_vertical_qty_per_portfolio(allocations)
+
+    slice_distribution: list[TupleDistributionAlias] = []
+
+    for order in orders:
+        quantity = order[0]
+        price = order[1]
+
+        remaining_order_qty = quantity
+        for portfolio, target_qty in target_qty_per_price.get(price, []):
+            if remaining_order_qty == 0:
+                break
+            max_qty_portfolio = remaining_vertical_qty_per_portfolio.get(portfolio, 0)
+            if max_qty_portfolio == 0:
+                continue
+
+            if jitter:
+                target_qty *= random.uniform(1 - jitter, 1 + jitter)
+            qty = min(int(target_qty), max_qty_portfolio, remaining_order_qty)
+            if qty == 0:
+                continue
+
+            remaining_order_qty -= qty
+            remaining_vertical_qty_per_portfolio[portfolio] -= qty
+
+            slice_distribution.append((qty, price, portfolio))
+
+        if remaining_order_qty == 0:
+            continue
+
+        # Leftovers from rounding and capped portfolios
+        active_portfolios = _drop_exhausted_portfolios(
+            list(remaining_vertical_qty_per_portfolio.keys()),
+            remaining_vertical_qty_per_portfolio,
+        )
+        random.shuffle(active_portfolios)
+        for portfolio in active_portfolios:
+            if remaining_order_qty == 0:
+                break
+            qty = min(
+                remaining_vertical_qty_per_portfolio[portfolio],
+                remaining_order_qty,
+            )
+
+            remaining_order_qty -= qty
+            remaining_vertical_qty_per_portfolio[portfolio] -= qty
+
+            slice_distribution.append((qty, price, portfolio))
+
+    return slice_distribution
+
+
+def _pick_balanced_pair(
+    remaining_qty_per_price: dict[float, int],
+    remaining_portfolio_qty: int,
+    portfolio_qty: int,
+    portfolio_volume: float,
+    avg_price: float,
+    price_slack: float,
+) -> tuple[tuple[int, float], tuple[int, float]] | None:
+    """
+    Splits the rest of a portfolio between two orders so that its average
+    price gets as close as possible to `avg_price`. Among splits within
+    `price_slack` (relative) of it, the ones that use up an order are
+    preferred, as every partly used order makes the next portfolios harder
+    to fit in the cap. Returns the two (qty, price), or None if no two
+    orders can take the rest.
+    """
+    open_prices = [p for p, r in remaining_qty_per_price.items() if r > 0]
+    total_qty = portfolio_qty + remaining_portfolio_qty
+    target_volume = avg_price * total_qty
+
+    # The most used orders are always tried, so they get used up first
+    candidates_a = set(
+        sorted(open_prices, key=lambda p: remaining_qty_per_price[p])[:2]
+    )
+    candidates_a.update(random.sample(open_prices, min(len(open_prices), 2)))
+
+    best_pair = None
+    best_key = (True, 0, float('inf'))
+    for price_a in candidates_a:
+        for price_b in open_prices:
+            if price_b == price_a:
+                continue
+            remaining_a = remaining_qty_per_price[price_a]
+            remaining_b = remaining_qty_per_price[price_b]
+            min_qty_a = max(1, remaining_portfolio_qty - remaining_b)
+            max_qty_a = min(remaining_a, remaining_portfolio_qty - 1)
+            if min_qty_a > max_qty_a:
+                continue
+
+            # qty_a that makes the portfolio average equal to avg_price
+            balanced_qty_a = (
+                target_volume - portfolio_volume - remaining_portfolio_qty * price_b
+            ) / (price_a - price_b)
+            balanced_qty_a = min(max(round(balanced_qty_a), min_qty_a), max_qty_a)
+
+            for qty_a in (balanced_qty_a, min_qty_a, max_qty_a):
+                qty_b = remaining_portfolio_qty - qty_a
+                volume = portfolio_volume + qty_a * price_a + qty_b * price_b
+                distance = abs(volume - target_volume) / target_volume
+                used_up = (qty_a == remaining_a) + (qty_b == remaining_b)
+                key = (distance > price_slack, -used_up, distance)
+                if key < best_key:
+                    best_key = key
+                    best_pair = ((qty_a, price_a), (qty_b, price_b))
+    return best_pair
+
+
+def distribute_slice_capped(
+    trades: list[TupleTradesAlias],
+    allocations: list[TupleAllocationAlias],
+    max_price_levels: int,
+    price_slack: float = 0.0,
+) -> list[TupleDistributionAlias]:
+    """
+    Gives each portfolio, from the largest to the smallest, quantity from at
+    most `max_price_levels` orders. Orders are picked at random, favouring
+    the ones that bring the portfolio average price closer to the average
+    price of all trades, and the last two are split to match it, within
+    `price_slack` (see `_pick_balanced_pair`).
+
+    Returns an empty list when some portfolio can not be filled within the
+    cap with what is left of the orders.
+    """
+    avg_price = _get_trades_average_price(trades)
+
+    remaining_qty_per_price: dict[float, int] = defaultdict(int)
+    for quantity, price in trades:
+        remaining_qty_per_price[price] += quantity
+
+    vertical_qty_per_portfolio = _get_vertical_qty_per_portfolio(allocations)
+    portfolios = list(vertical_qty_per_portfolio.keys())
+    random.shuffle(portfolios)
+    portfolios.sort(key=lambda p: vertical_qty_per_portfolio[p], reverse=True)
+
+    slice_distribution: list[TupleDistributionAlias] = []
+
+    for portfolio in portfolios:
+        remaining_portfolio_qty = vertical_qty_per_portfolio[portfolio]
+        portfolio_qty = 0
+        portfolio_volume = 0.0
+
+        for levels_left in range(max_price_levels, 0, -1):
+            if remaining_portfolio_qty == 0:
+                break
+
+            if levels_left == 2 and remaining_portfolio_qty > 1:
+                pair = _pick_balanced_pair(
+                    remaining_qty_per_price,
+                    remaining_portfolio_qty,
+                    portfolio_qty,
+                    portfolio_volume,
+                    avg_price,
+                    price_slack,
+                )
+                if pair is not None:
+                    for qty, price in pair:
+                        remaining_qty_per_price[price] -= qty
+                        slice_distribution.append((qty, price, portfolio))
+                    remaining_portfolio_qty = 0
+                    break
+
+            open_prices = [p for p, r in remaining_qty_per_price.items() if r > 0]
+            max_remaining = max(remaining_qty_per_price[p] for p in open_prices)
+
+            if levels_left == 1:
+                # The last order has to fit the rest of the portfolio
+                candidates = [
+                    p
+                    for p in open_prices
+                    if remaining_qty_per_price[p] >= remaining_portfolio_qty
+                ]
+            elif remaining_portfolio_qty > max_remaining * (levels_left - 1):
+                # Only the largest orders leave the rest coverable
+                candidates = [
+                    p
+                    for p in open_prices
+                    if remaining_qty_per_price[p] == max_remaining
+                ]
+            else:
+                candidates = open_prices
+            if not candidates:
+                return []
+
+            def _avg_price_distance(price: float) -> float:
+                qty = min(remaining_qty_per_price[price], remaining_portfolio_qty)
+                new_avg = (portfolio_volume + qty * price) / (portfolio_qty + qty)
+                return abs(new_avg - avg_price)
+
+            sample = random.sample(candidates, min(len(candidates), 3))
+            price = min(sample, key=_avg_price_distance)
+            qty = min(remaining_qty_per_price[price], remaining_portfolio_qty)
+
+            remaining_qty_per_price[price] -= qty
+            remaining_portfolio_qty -= qty
+            portfolio_qty += qty
+            portfolio_volume += qty * price
+
+            slice_distribution.append((qty, price, portfolio))
+
+        if remaining_portfolio_qty > 0:
+            return []
+
+    return slice_distribution
@@ -37,6 +37,16 @@ def distribution_max_deviation(distribution: list[TupleDistributionAlias]) -> fl
     return abs(max_value / min_value - 1)
 
 
+def distribution_price_levels(
+    distribution: list[TupleDistributionAlias],
+) -> dict[str, int]:
+    """Returns a dict containing the number of distinct prices for each portfolio"""
+    prices_per_portfolio: dict[str, set[float]] = defaultdict(set)
+    for _, price, portfolio in distribution:
+        prices_per_portfolio[portfolio].add(price)
+    return {k: len(v) for k, v in prices_per_portfolio.items()}
+
+
 def add_slice_data_to_distribution(
     slice: Slice,
     slice_distribution: list[TupleDistributionAlias],
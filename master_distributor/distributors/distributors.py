@@ -1,25 +1,33 @@
 import time
+import warnings
 
 from typing import Protocol, Callable
 
 import pandas as pd
 
-from master_distributor.parser import parse_data
+from master_distributor.parser import Slice, parse_data
+from master_distributor.warm_start import WarmStartStore, pattern_target_qty
 from master_distributor._types import (
     TupleDistributionAlias,
     FuncDistributeAlias,
     TupleFullDistributionAlias,
     TradesRowsAlias,
     AllocationsRowsAlias,
+    TupleTradesAlias,
+    TupleAllocationAlias,
 )
 from ._utils import (
     distribution_max_deviation,
+    distribution_price_levels,
     distribution_as_dataframe,
     add_slice_data_to_distribution,
 )
 from ._slice_distributors import (
     distribute_slice_weighted,
     distribute_slice_random,
+    distribute_slice_pieces,
+    distribute_slice_capped,
+    distribute_slice_pattern,
 )
 
 
@@ -33,6 +41,17 @@ class Distributor(Protocol):
     ) -> pd.DataFrame:
         ...
 
+    def distribute_slice(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        slice: Slice | None = None,
+    ) -> list[TupleDistributionAlias]:
+        ...
+
+    def flush(self):
+        """Saves the state kept between runs, if any. Nothing by default"""
+
 
 class WeightedDistributor(Distributor):
     def __init__(self, verbose: bool = False):
@@ -51,6 +70,17 @@ class WeightedDistributor(Distributor):
             verbose=self._verbose,
         )
 
+    def distribute_slice(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        slice: Slice | None = None,
+    ) -> list[TupleDistributionAlias]:
+        return self._func_distribute_slice(
+            trades_slice_rows,  # type: ignore
+            allocations_slice_rows,  # type: ignore
+        )
+
 
 class RandomLoopDistributor(Distributor):
     def __init__(
@@ -59,12 +89,14 @@ class RandomLoopDistributor(Distributor):
         std_break: float | None = None,
         else_return_best: bool = True,
         max_its: int = 1_000,
+        warm_start: WarmStartStore | None = None,
         verbose: bool = False,
     ):
         self._shuffle_orders = shuffle_orders
         self._std_break = std_break
         self._else_return_best = else_return_best
         self._max_its = max_its
+        self._warm_start = warm_start
         self._verbose = verbose
 
         self._func_distribute_slice: FuncDistributeAlias = distribute_slice_random
@@ -82,7 +114,375 @@ class RandomLoopDistributor(Distributor):
             std_break=self._std_break,
             max_its=self._max_its,
             verbose=self._verbose,
+            warm_start=self._warm_start,
+        )
+
+    def distribute_slice(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        slice: Slice | None = None,
+    ) -> list[TupleDistributionAlias]:
+        """
+        The warm-start store is only used when `slice` is given, as its
+        entries are keyed by ticker and side. It is not saved here: call
+        `flush` once all the slices are done.
+        """
+        return _loop_get_best_slice_distribution(
+            trades_slice_rows=trades_slice_rows,
+            allocations_slice_rows=allocations_slice_rows,
+            slice=slice,
+            func_distribute_slice=self._func_distribute_slice,
+            max_its=self._max_its,
+            std_break=self._std_break if self._std_break else 0,
+            verbose=self._verbose,
+            warm_start=self._warm_start,
+        )
+
+    def flush(self):
+        if self._warm_start is not None:
+            self._warm_start.save()
+
+
+class MinLinesDistributor(Distributor):
+    """
+    Searches for the distribution with the fewest (price, portfolio) lines
+    whose max deviation is within `max_deviation`.
+
+    Without `max_price_levels`, portfolios are split in 1, 2, 3... pieces and
+    the search stops at the first number of pieces that meets the tolerance.
+    If none does, the lowest deviation found is returned with a warning.
+
+    With `max_price_levels`, every candidate gives each portfolio at most that
+    many distinct prices. If none of them meets the tolerance, the search
+    above is used instead, ignoring the cap, with a warning. If that does not
+    meet the tolerance either, the best capped distribution is returned, or
+    the best uncapped one when the cap can not be met at all, with a warning.
+
+    Warnings name the slice when it is known.
+    """
+
+    def __init__(
+        self,
+        max_deviation: float,
+        max_price_levels: int | None = None,
+        max_its: int = 1_000,
+        verbose: bool = False,
+    ):
+        if max_price_levels is not None and max_price_levels < 1:
+            raise ValueError('max_price_levels must be at least 1')
+
+        self._max_deviation = max_deviation
+        self._max_price_levels = max_price_levels
+        self._max_its = max_its
+        self._verbose = verbose
+
+    def distribute(
+        self,
+        trades: pd.DataFrame,
+        allocations: pd.DataFrame,
+    ) -> pd.DataFrame:
+        data = parse_data(master=trades, allocations=allocations)
+
+        distribution: list[TupleFullDistributionAlias] = []
+        for master_slice_rows, allocations_slice_rows, slice in data.items_raw():
+            slice_distribution = self.distribute_slice(
+                master_slice_rows, allocations_slice_rows, slice=slice
+            )
+            distribution += add_slice_data_to_distribution(slice, slice_distribution)
+        return distribution_as_dataframe(distribution)
+
+    def distribute_slice(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        slice: Slice | None = None,
+    ) -> list[TupleDistributionAlias]:
+        slice_name = ''
+        if slice is not None:
+            slice_name = f'{slice["BROKER"]} {slice["TICKER"]} {slice["SIDE"]}: '
+
+        if self._max_price_levels is None:
+            distribution, score = self._search_pieces(
+                trades_slice_rows, allocations_slice_rows
+            )
+            if score[0] > 0:
+                warnings.warn(
+                    f'{slice_name}max_deviation not met, '
+                    f'best max deviation is {score[2]:,.2%}'
+                )
+            return distribution
+
+        capped_distribution, capped_score = self._search_capped(
+            trades_slice_rows, allocations_slice_rows, self._max_price_levels
+        )
+        if capped_distribution and capped_score[0] == 0:
+            return capped_distribution
+
+        distribution, score = self._search_pieces(
+            trades_slice_rows, allocations_slice_rows
+        )
+        if score[0] == 0:
+            warnings.warn(
+                f'{slice_name}max_price_levels and max_deviation can not both '
+                'be met, ignoring max_price_levels'
+            )
+            return distribution
+
+        if capped_distribution:
+            warnings.warn(
+                f'{slice_name}max_deviation not met, best max deviation '
+                f'within max_price_levels is {capped_score[2]:,.2%}'
+            )
+            return capped_distribution
+
+        warnings.warn(
+            f'{slice_name}max_price_levels can not be met and max_deviation '
+            f'not met, best max deviation is {score[2]:,.2%}'
+        )
+        return distribution
+
+    def _search_pieces(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+    ) -> tuple[list[TupleDistributionAlias], tuple[float, int, float]]:
+        min_lines = _min_lines(trades_slice_rows, allocations_slice_rows)
+
+        # A portfolio with more pieces than orders does not get more prices
+        max_pieces = len(trades_slice_rows)
+        its_per_pieces = max(self._max_its // max_pieces, 1)
+
+        best_distribution: list[TupleDistributionAlias] = []
+        best_score: tuple[float, int, float] = (float('inf'), 0, float('inf'))
+        pieces = 0
+        it = 0
+
+        start = time.time()
+        for pieces in range(1, max_pieces + 1):
+            for _ in range(its_per_pieces):
+                it += 1
+                slice_distribution = distribute_slice_pieces(
+                    trades_slice_rows,
+                    allocations_slice_rows,
+                    pieces_per_portfolio=pieces,
+                )
+                score = self._score(slice_distribution)
+                if score < best_score:
+                    best_score = score
+                    best_distribution = slice_distribution
+                if best_score[0] == 0 and best_score[1] <= min_lines:
+                    break
+            # More pieces only add lines once the tolerance is met
+            if best_score[0] == 0:
+                break
+        end = time.time()
+
+        if self._verbose:
+            print(
+                f'{it=}',
+                round(end - start, 4),
+                f'{pieces=}, lines={best_score[1]}, best_std={best_score[2]:,.2%}',
+            )
+        return best_distribution, best_score
+
+    def _search_capped(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        max_price_levels: int,
+    ) -> tuple[list[TupleDistributionAlias], tuple[float, int, float]]:
+        """Returns an empty distribution if no candidate respects the cap"""
+        min_lines = _min_lines(trades_slice_rows, allocations_slice_rows)
+
+        best_distribution: list[TupleDistributionAlias] = []
+        best_score: tuple[float, int, float] = (float('inf'), 0, float('inf'))
+        it = 0
+
+        start = time.time()
+        for it in range(1, self._max_its + 1):
+            if it % 2 == 1:
+                # Portfolios within half the tolerance of the average price
+                # keep the max deviation within it.
+                slice_distribution = distribute_slice_capped(
+                    trades_slice_rows,
+                    allocations_slice_rows,
+                    max_price_levels=max_price_levels,
+                    price_slack=self._max_deviation / 2,
+                )
+            else:
+                # Contiguous fills always respect the cap when portfolios
+                # are small next to the orders, where the above can fail.
+                slice_distribution = distribute_slice_pieces(
+                    trades_slice_rows, allocations_slice_rows
+                )
+                price_levels = distribution_price_levels(slice_distribution)
+                if max(price_levels.values()) > max_price_levels:
+                    continue
+            if not slice_distribution:
+                continue
+            score = self._score(slice_distribution)
+            if score < best_score:
+                best_score = score
+                best_distribution = slice_distribution
+            if best_score[0] == 0 and best_score[1] <= min_lines:
+                break
+        end = time.time()
+
+        if self._verbose:
+            print(
+                f'{it=}',
+                round(end - start, 4),
+                f'{max_price_levels=}, lines={best_score[1]}, '
+                f'best_std={best_score[2]:,.2%}',
+            )
+        return best_distribution, best_score
+
+    def _score(
+        self,
+        distribution: list[TupleDistributionAlias],
+    ) -> tuple[float, int, float]:
+        """
+        Score to be minimized: deviation above the tolerance, number of lines
+        and deviation, in this order.
+        """
+        price_levels = distribution_price_levels(distribution)
+        dist_std = distribution_max_deviation(distribution)
+
+        std_excess = max(dist_std - self._max_deviation, 0)
+        n_lines = sum(price_levels.values())
+        return std_excess, n_lines, dist_std
+
+
+def _min_lines(
+    trades_slice_rows: TradesRowsAlias,
+    allocations_slice_rows: AllocationsRowsAlias,
+) -> int:
+    """Every order and every portfolio needs at least one line"""
+    n_portfolios = len({p for p, qty in allocations_slice_rows if qty != 0})
+    return max(len(trades_slice_rows), n_portfolios)
+
+
+_TIERED_REPORT_COLUMNS = [
+    'BROKER',
+    'TICKER',
+    'SIDE',
+    'TIER',
+    'DISTRIBUTOR',
+    'MAX_DEVIATION',
+    'RESOLVED',
+]
+
+
+class TieredDistributor(Distributor):
+    """
+    Runs a chain of distributors for every slice, from the cheapest to the
+    most expensive one. A slice only escalates to the next tier when its
+    max deviation is not below `max_deviation`, the same criterion as the
+    `std_break` of `RandomLoopDistributor`.
+
+    After `distribute`, `report` holds the tier of the distribution kept for
+    each slice. `RESOLVED` is False for slices where no tier got below
+    `max_deviation`, in which case the best distribution of all tiers is kept.
+    """
+
+    def __init__(
+        self,
+        max_deviation: float,
+        tiers: list[Distributor] | None = None,
+        verbose: bool = False,
+    ):
+        if tiers is None:
+            tiers = [
+                WeightedDistributor(),
+                RandomLoopDistributor(std_break=max_deviation),
+            ]
+        if not tiers:
+            raise ValueError('tiers must have at least one distributor')
+
+        self._max_deviation = max_deviation
+        self._tiers = tiers
+        self._verbose = verbose
+
+        self.report: pd.DataFrame = pd.DataFrame(columns=_TIERED_REPORT_COLUMNS)
+
+    def distribute(
+        self,
+        trades: pd.DataFrame,
+        allocations: pd.DataFrame,
+    ) -> pd.DataFrame:
+        data = parse_data(master=trades, allocations=allocations)
+
+        distribution: list[TupleFullDistributionAlias] = []
+        report_rows: list[tuple[str, str, str, int, str, float, bool]] = []
+
+        for master_slice_rows, allocations_slice_rows, slice in data.items_raw():
+            best_distribution, best_tier, best_std = self._distribute_slice_tiered(
+                master_slice_rows, allocations_slice_rows, slice
+            )
+            resolved = best_std < self._max_deviation
+            if self._verbose:
+                print(
+                    slice['BROKER'],
+                    slice['TICKER'],
+                    slice['SIDE'],
+                    f'tier={best_tier}, best_std={best_std:,.2%}, {resolved=}',
+                )
+
+            report_rows.append(
+                (
+                    slice['BROKER'],
+                    slice['TICKER'],
+                    slice['SIDE'],
+                    best_tier,
+                    type(self._tiers[best_tier]).__name__,
+                    best_std,
+                    resolved,
+                )
+            )
+            distribution += add_slice_data_to_distribution(slice, best_distribution)
+
+        self.flush()
+        self.report = pd.DataFrame(report_rows, columns=_TIERED_REPORT_COLUMNS)
+        return distribution_as_dataframe(distribution)
+
+    def distribute_slice(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        slice: Slice | None = None,
+    ) -> list[TupleDistributionAlias]:
+        best_distribution, _, _ = self._distribute_slice_tiered(
+            trades_slice_rows, allocations_slice_rows, slice
         )
+        return best_distribution
+
+    def flush(self):
+        for distributor in self._tiers:
+            distributor.flush()
+
+    def _distribute_slice_tiered(
+        self,
+        trades_slice_rows: TradesRowsAlias,
+        allocations_slice_rows: AllocationsRowsAlias,
+        slice: Slice | None,
+    ) -> tuple[list[TupleDistributionAlias], int, float]:
+        """Returns the best distribution, the tier that found it and its std"""
+        best_distribution: list[TupleDistributionAlias] = []
+        best_tier = 0
+        best_std = float('inf')
+        for tier, distributor in enumerate(self._tiers):
+            slice_distribution = distributor.distribute_slice(
+                trades_slice_rows, allocations_slice_rows, slice=slice
+            )
+            dist_std = distribution_max_deviation(slice_distribution)
+            if dist_std < best_std:
+                best_std = dist_std
+                best_tier = tier
+                best_distribution = slice_distribution
+            if best_std < self._max_deviation:
+                break
+        return best_distribution, best_tier, best_std
 
 
 def _single_distributor(
@@ -113,7 +513,12 @@ def _loop_get_best_distribution(
     max_its: int,
     std_break: float,
     verbose: bool = False,
+    func_distribute_slice_seeded: FuncDistributeAlias | None = None,
 ) -> list[TupleDistributionAlias]:
+    """
+    If `func_distribute_slice_seeded` is given, it is used on the first and
+    then every other iteration, the remaining ones are still random.
+    """
     best_distribution: list[TupleDistributionAlias] = []
     best_std = float('inf')
     dist_std = float('inf')
@@ -121,7 +526,10 @@ def _loop_get_best_distribution(
 
     start = time.time()
     for it in range(1, max_its + 1):
-        slice_distribution = func_distribute_slice(
+        func = func_distribute_slice
+        if func_distribute_slice_seeded is not None and it % 2 == 1:
+            func = func_distribute_slice_seeded
+        slice_distribution = func(
             trades_slice_rows,  # type: ignore
             allocations_slice_rows,  # type: ignore
         )
@@ -159,6 +567,7 @@ def _loop_distributor(
     std_break: float | None,
     max_its: int,
     verbose: bool,
+    warm_start: WarmStartStore | None = None,
 ) -> pd.DataFrame:
     std_break = std_break if std_break else 0
     data = parse_data(master=trades, allocations=allocations)
@@ -180,19 +589,102 @@ def _loop_distributor(
         #         best_std = dist_std
         #         best_distribution = _slice_distribution
         #     it += 1
-        best_distribution = _loop_get_best_distribution(
+        best_distribution = _loop_get_best_slice_distribution(
             trades_slice_rows=master_slice_rows,
             allocations_slice_rows=allocations_slice_rows,
+            slice=slice,
             func_distribute_slice=func_distribute_slice,
             max_its=max_its,
             std_break=std_break,
             verbose=verbose,
+            warm_start=warm_start,
         )
 
         distribution += add_slice_data_to_distribution(slice, best_distribution)
+
+    if warm_start is not None:
+        warm_start.save()
     return distribution_as_dataframe(distribution)
 
 
+def _loop_get_best_slice_distribution(
+    trades_slice_rows: TradesRowsAlias,
+    allocations_slice_rows: AllocationsRowsAlias,
+    slice: Slice | None,
+    func_distribute_slice: FuncDistributeAlias,
+    max_its: int,
+    std_break: float,
+    verbose: bool,
+    warm_start: WarmStartStore | None,
+) -> list[TupleDistributionAlias]:
+    """
+    `_loop_get_best_distribution` seeded from and stored into `warm_start`,
+    when there is one and the slice is known. The store is not saved here.
+    """
+    if warm_start is None or slice is None:
+        return _loop_get_best_distribution(
+            trades_slice_rows=trades_slice_rows,
+            allocations_slice_rows=allocations_slice_rows,
+            func_distribute_slice=func_distribute_slice,
+            max_its=max_its,
+            std_break=std_break,
+            verbose=verbose,
+        )
+
+    func_distribute_slice_seeded: FuncDistributeAlias | None = None
+    pattern = warm_start.get(slice['TICKER'], slice['SIDE'], allocations_slice_rows)
+    if pattern:
+        func_distribute_slice_seeded = _warm_start_func_distribute_slice(
+            pattern_target_qty(trades_slice_rows, pattern),
+            warm_start.jitter,
+        )
+
+    best_distribution = _loop_get_best_distribution(
+        trades_slice_rows=trades_slice_rows,
+        allocations_slice_rows=allocations_slice_rows,
+        func_distribute_slice=func_distribute_slice,
+        max_its=max_its,
+        std_break=std_break,
+        verbose=verbose,
+        func_distribute_slice_seeded=func_distribute_slice_seeded,
+    )
+
+    warm_start.put(
+        slice['TICKER'],
+        slice['SIDE'],
+        allocations_slice_rows,
+        trades_slice_rows,
+        best_distribution,
+    )
+    return best_distribution
+
+
+def _warm_start_func_distribute_slice(
+    target_qty_per_price: dict[float, list[tuple[str, float]]],
+    jitter: float,
+) -> FuncDistributeAlias:
+    """
+    The first call follows the pattern as is, the following ones add jitter
+    so the search refines around it.
+    """
+    calls = 0
+
+    def func(
+        trades: list[TupleTradesAlias],
+        allocations: list[TupleAllocationAlias],
+    ) -> list[TupleDistributionAlias]:
+        nonlocal calls
+        calls += 1
+        return distribute_slice_pattern(
+            trades,
+            allocations,
+            target_qty_per_price=target_qty_per_price,
+            jitter=jitter if calls > 1 else 0.0,
+        )
+
+    return func
+
+
 def _parallel_loop_distributor(
     trades: pd.DataFrame,
     allocations: pd.DataFrame,
@@ -0,0 +1,249 @@
+"""
+Warm-start store for the loop distributors.
+
+For every (TICKER, SIDE, allocation ratios) it keeps the split pattern of
+the best distribution found in the last run: which fraction of each price
+quantile went to each portfolio. Recurring flows can then start the search
+from that pattern instead of from nothing.
+"""
+
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import time
+import warnings
+
+from master_distributor._types import (
+    AllocationsRowsAlias,
+    PatternAlias,
+    TradesRowsAlias,
+    TupleDistributionAlias,
+)
+
+_FILE_VERSION = 2
+
+
+class WarmStartStore:
+    def __init__(
+        self,
+        path: str,
+        max_age_days: float = 30,
+        n_quantiles: int = 10,
+        jitter: float = 0.1,
+    ):
+        if n_quantiles < 1:
+            raise ValueError('n_quantiles must be at least 1')
+
+        self._path = path
+        self._max_age_days = max_age_days
+        self._n_quantiles = n_quantiles
+        self._jitter = jitter
+
+        self._entries: dict[str, dict] = {}  # type: ignore
+        self._dirty = False
+        self.load()
+
+    @property
+    def jitter(self) -> float:
+        return self._jitter
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def load(self):
+        self._entries = {}
+        self._dirty = False
+        if not os.path.exists(self._path):
+            return
+
+        # Whatever can not be read is dropped with a warning, the next save
+        # replaces it.
+        try:
+            with open(self._path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != _FILE_VERSION:
+                warnings.warn(
+                    f'Warm-start store {self._path} has version '
+                    f'{data.get("version")}, expected {_FILE_VERSION}; '
+                    'its patterns are dropped'
+                )
+                return
+            self._entries = data['entries']
+            self._evict()
+        except (OSError, ValueError, AttributeError, KeyError, TypeError) as e:
+            warnings.warn(
+                f'Warm-start store {self._path} could not be read ({e!r}); '
+                'its patterns are dropped'
+            )
+            self._entries = {}
+
+    def save(self):
+        """Writes the store to disk, if anything changed since the last load/save"""
+        self._evict()
+        if not self._dirty:
+            return
+        data = {'version': _FILE_VERSION, 'entries': self._entries}
+        # Written to a temporary file first, so a crash mid-write does not
+        # leave a broken store behind. mkstemp creates it readable by the
+        # owner only, so the mode of the replaced file is kept.
+        dir_path = os.path.dirname(os.path.abspath(self._path))
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.chmod(tmp_path, _file_mode(self._path))
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._dirty = False
+
+    def get(
+        self,
+        ticker: str,
+        side: str,
+        allocations: AllocationsRowsAlias,
+    ) -> PatternAlias | None:
+        key = _store_key(ticker, side, allocations, self._n_quantiles)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry['pattern']
+
+    def put(
+        self,
+        ticker: str,
+        side: str,
+        allocations: AllocationsRowsAlias,
+        trades: TradesRowsAlias,
+        distribution: list[TupleDistributionAlias],
+    ):
+        if not distribution:
+            return
+        key = _store_key(ticker, side, allocations, self._n_quantiles)
+        pattern = distribution_pattern(trades, distribution, self._n_quantiles)
+        self._entries[key] = {
+            'updated': time.time(),
+            'pattern': {
+                portfolio: [round(f, 4) for f in fractions]
+                for portfolio, fractions in pattern.items()
+            },
+        }
+        self._dirty = True
+
+    def _evict(self):
+        min_updated = time.time() - self._max_age_days * 24 * 60 * 60
+        entries = {
+            k: v for k, v in self._entries.items() if v['updated'] >= min_updated
+        }
+        if len(entries) != len(self._entries):
+            self._entries = entries
+            self._dirty = True
+
+
+def _file_mode(path: str) -> int:
+    """Mode of the existing file, or the default one for a new file"""
+    if os.path.exists(path):
+        return stat.S_IMODE(os.stat(path).st_mode)
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _allocations_signature(allocations: AllocationsRowsAlias) -> str:
+    """Hash of the allocation ratios, rounded to 3 significant digits"""
+    total_qty = sum(qty for _, qty in allocations)
+    ratios = sorted(
+        (portfolio, f'{qty / total_qty:.3g}')
+        for portfolio, qty in allocations
+        if qty != 0
+    )
+    return hashlib.sha1(repr(ratios).encode()).hexdigest()[:16]
+
+
+def _store_key(
+    ticker: str,
+    side: str,
+    allocations: AllocationsRowsAlias,
+    n_quantiles: int,
+) -> str:
+    # Stores with different n_quantiles can share a file without clashing
+    return f'{ticker}|{side}|{n_quantiles}|{_allocations_signature(allocations)}'
+
+
+def price_quantiles_overlap(
+    trades: TradesRowsAlias,
+    n_quantiles: int,
+) -> dict[float, list[int]]:
+    """
+    Returns, for each price, how much of its quantity falls in each price
+    quantile. Quantiles are equal slices of the total quantity, sorted by
+    price.
+    """
+    orders = sorted(trades, key=lambda x: x[1])
+    total_qty = sum(qty for qty, _ in orders)
+    bounds = [total_qty * q // n_quantiles for q in range(n_quantiles + 1)]
+
+    overlap_per_price: dict[float, list[int]] = {}
+    order_start = 0
+    for qty, price in orders:
+        order_end = order_start + qty
+        overlap_per_price[price] = [
+            max(min(order_end, bounds[q + 1]) - max(order_start, bounds[q]), 0)
+            for q in range(n_quantiles)
+        ]
+        order_start = order_end
+    return overlap_per_price
+
+
+def distribution_pattern(
+    trades: TradesRowsAlias,
+    distribution: list[TupleDistributionAlias],
+    n_quantiles: int,
+) -> PatternAlias:
+    """
+    Returns the fraction of every price quantile that went to each
+    portfolio. A portfolio share of a price is assumed to be spread evenly
+    over the quantiles that price falls in.
+    """
+    overlap_per_price = price_quantiles_overlap(trades, n_quantiles)
+    qty_per_price = {
+        price: sum(overlap) for price, overlap in overlap_per_price.items()
+    }
+
+    quantile_qty = [0] * n_quantiles
+    for overlap in overlap_per_price.values():
+        for q in range(n_quantiles):
+            quantile_qty[q] += overlap[q]
+
+    pattern: PatternAlias = {}
+    for qty, price, portfolio in distribution:
+        fractions = pattern.setdefault(portfolio, [0.0] * n_quantiles)
+        share = qty / qty_per_price[price]
+        for q, overlap in enumerate(overlap_per_price[price]):
+            if overlap and quantile_qty[q]:
+                fractions[q] += share * overlap / quantile_qty[q]
+    return pattern
+
+
+def pattern_target_qty(
+    trades: TradesRowsAlias,
+    pattern: PatternAlias,
+) -> dict[float, list[tuple[str, float]]]:
+    """Returns, for each price, the quantity the pattern gives to each portfolio"""
+    if not pattern:
+        return {}
+    n_quantiles = len(next(iter(pattern.values())))
+    overlap_per_price = price_quantiles_overlap(trades, n_quantiles)
+
+    target_qty_per_price: dict[float, list[tuple[str, float]]] = {}
+    for price, overlap in overlap_per_price.items():
+        targets: list[tuple[str, float]] = []
+        for portfolio, fractions in pattern.items():
+            target_qty = sum(o * f for o, f in zip(overlap, fractions))
+            if target_qty >= 1:
+                targets.append((portfolio, target_qty))
+        target_qty_per_price[price] = targets
+    return target_qty_per_price
@@ -1,11 +1,20 @@
+import os
+import random
+import stat
+import tempfile
+import warnings
 from unittest import TestCase
 
 import pandas as pd
 
 from master_distributor.distributors import (
+    MinLinesDistributor,
     RandomLoopDistributor,
+    TieredDistributor,
+    WeightedDistributor,
 )
 from master_distributor.utils import verify_distribution
+from master_distributor.warm_start import WarmStartStore
 
 # Read samples
 master_sample = pd.read_csv('samples/master_sample.csv', sep=';', decimal=',')  # type: ignore
@@ -31,3 +40,273 @@ class TestRandomDistribution(TestCase):
         )
         distribution = distributor.distribute(master_sample, allocations_sample)
         assert verify_distribution(distribution, master_sample)
+
+
+class TestTieredDistribution(TestCase):
+    def test_distribution_default_tiers(self):
+        distributor = TieredDistributor(max_deviation=0.05 / 100)
+        distribution = distributor.distribute(master_sample, allocations_sample)
+        assert verify_distribution(distribution, master_sample)
+        assert len(distributor.report) > 0
+        assert distributor.report['TIER'].isin([0, 1]).all()
+        resolved = distributor.report['MAX_DEVIATION'] < 0.05 / 100
+        assert (distributor.report['RESOLVED'] == resolved).all()
+
+    def test_distribution_resolved_by_first_tier(self):
+        distributor = TieredDistributor(
+            max_deviation=1.0,
+            tiers=[WeightedDistributor(), RandomLoopDistributor()],
+        )
+        distribution = distributor.distribute(master_sample, allocations_sample)
+        assert verify_distribution(distribution, master_sample)
+        assert (distributor.report['TIER'] == 0).all()
+        assert (distributor.report['DISTRIBUTOR'] == 'WeightedDistributor').all()
+        assert distributor.report['RESOLVED'].all()
+
+    def test_distribution_unresolved(self):
+        distributor = TieredDistributor(
+            max_deviation=0,
+            tiers=[WeightedDistributor(), RandomLoopDistributor(max_its=10)],
+        )
+        distribution = distributor.distribute(master_sample, allocations_sample)
+        assert verify_distribution(distribution, master_sample)
+        assert not distributor.report['RESOLVED'].any()
+
+
+class TestWeightedDistribution(TestCase):
+    def test_distribution(self):
+        distributor = WeightedDistributor()
+        distribution = distributor.distribute(master_sample, allocations_sample)
+        assert verify_distribution(distribution, master_sample)
+
+        keys = ['BROKER', 'TICKER', 'SIDE', 'PORTFOLIO']
+        dist_qty = distribution.groupby(keys)['QUANTITY'].sum()
+        allocations_qty = allocations_sample.groupby(keys)['QUANTITY'].sum()
+        assert dist_qty.sort_index().equals(allocations_qty.sort_index())
+
+
+def _slice_sample(
+    orders: list[tuple[int, float]],
+    portfolio_qtys: list[int],
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    master = pd.DataFrame(
+        [('XP', 'PETR4', 'C', qty, price) for qty, price in orders],
+        columns=['BROKER', 'TICKER', 'SIDE', 'QUANTITY', 'PRICE'],
+    )
+    allocations = pd.DataFrame(
+        [
+            ('XP', 'PETR4', 'C', qty, f'P{i:04d}')
+            for i, qty in enumerate(portfolio_qtys)
+        ],
+        columns=['BROKER', 'TICKER', 'SIDE', 'QUANTITY', 'PORTFOLIO'],
+    )
+    return master, allocations
+
+
+def _many_portfolios_sample(
+    n_portfolios: int, n_orders: int
+) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """One slice with many small accounts, plus a zero quantity order"""
+    rng = random.Random(0)
+    orders = [(rng.randint(1, 20) * 100, 30 + i / 1000) for i in range(n_orders)]
+    orders.append((0, 29.0))
+    total_qty = sum(qty for qty, _ in orders)
+    cuts = sorted(rng.sample(range(1, total_qty), n_portfolios - 1))
+    portfolio_qtys = [b - a for a, b in zip([0, *cuts], [*cuts, total_qty])]
+    return _slice_sample(orders, portfolio_qtys)
+
+
+def _min_lines_sample(n_portfolios: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    One slice with fills within 1% of each other and equal portfolios, all
+    smaller than the smallest order, so every portfolio fits in 2 prices.
+    """
+    rng = random.Random(0)
+    orders = [
+        (
+            rng.randint(10, 20) * 100,
+            round(30 + rng.uniform(-0.15, 0.15), 2) + i / 10_000,
+        )
+        for i in range(30)
+    ]
+    total_qty = sum(qty for qty, _ in orders)
+    portfolio_qtys = [total_qty // n_portfolios] * n_portfolios
+    portfolio_qtys[-1] += total_qty - sum(portfolio_qtys)
+    return _slice_sample(orders, portfolio_qtys)
+
+
+class TestManyPortfoliosDistribution(TestCase):
+    def test_distribution(self):
+        master, allocations = _many_portfolios_sample(n_portfolios=3_000, n_orders=500)
+        for distributor in [WeightedDistributor(), RandomLoopDistributor(max_its=3)]:
+            distribution = distributor.distribute(master, allocations)
+            assert verify_distribution(distribution, master[master['QUANTITY'] > 0])
+            assert (distribution['QUANTITY'] > 0).all()
+
+            dist_qty = distribution.groupby('PORTFOLIO')['QUANTITY'].sum()
+            allocations_qty = allocations.groupby('PORTFOLIO')['QUANTITY'].sum()
+            assert dist_qty.sort_index().equals(allocations_qty.sort_index())
+
+
+def _max_deviation_per_slice(distribution: pd.DataFrame) -> pd.Series:
+    distribution = distribution.assign(
+        VOLUME=distribution['QUANTITY'] * distribution['PRICE']
+    )
+    totals = distribution.groupby(['BROKER', 'TICKER', 'SIDE', 'PORTFOLIO'])[
+        ['VOLUME', 'QUANTITY']
+    ].sum()
+    avg_price = (totals['VOLUME'] / totals['QUANTITY']).groupby(
+        ['BROKER', 'TICKER', 'SIDE']
+    )
+    return avg_price.max() / avg_price.min() - 1
+
+
+class TestMinLinesDistribution(TestCase):
+    def test_distribution_max_price_levels(self):
+        random.seed(0)
+        master, allocations = _min_lines_sample(n_portfolios=60)
+        max_deviation = 0.5 / 100
+        distributor = MinLinesDistributor(
+            max_deviation=max_deviation,
+            max_price_levels=2,
+        )
+        with warnings.catch_warnings():
+            # The slice is feasible, so there must be no fallback
+            warnings.simplefilter('error')
+            distribution = distributor.distribute(master, allocations)
+        assert verify_distribution(distribution, master)
+
+        price_levels = distribution.groupby('PORTFOLIO')['PRICE'].nunique()
+        assert (price_levels <= 2).all()
+        assert (_max_deviation_per_slice(distribution) <= max_deviation).all()
+
+        for other_distributor in [
+            WeightedDistributor(),
+            RandomLoopDistributor(max_its=100),
+        ]:
+            other_distribution = other_distributor.distribute(master, allocations)
+            assert len(distribution) < len(other_distribution)
+
+    def test_distribution_fallback(self):
+        random.seed(0)
+        # A single order can not take the largest portfolio
+        master, allocations = _slice_sample(
+            orders=[(1_000, 10.0), (1_000, 10.01), (1_000, 10.02)],
+            portfolio_qtys=[1_500, 1_000, 500],
+        )
+        max_deviation = 0.5 / 100
+        distributor = MinLinesDistributor(
+            max_deviation=max_deviation,
+            max_price_levels=1,
+        )
+        with self.assertWarnsRegex(UserWarning, 'XP PETR4 C'):
+            distribution = distributor.distribute(master, allocations)
+        assert verify_distribution(distribution, master)
+        assert (_max_deviation_per_slice(distribution) <= max_deviation).all()
+
+
+class TestWarmStartDistribution(TestCase):
+    def test_distribution_warm_start(self):
+        random.seed(0)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            distributor = RandomLoopDistributor(
+                max_its=500, warm_start=WarmStartStore(path)
+            )
+            stored = distributor.distribute(master_sample, allocations_sample)
+            assert len(WarmStartStore(path)) > 0
+
+            # A single iteration only runs the seeded path, with no jitter
+            distributor = RandomLoopDistributor(
+                max_its=1, warm_start=WarmStartStore(path)
+            )
+            seeded = distributor.distribute(master_sample, allocations_sample)
+            assert verify_distribution(seeded, master_sample)
+
+        cold = RandomLoopDistributor(max_its=1).distribute(
+            master_sample, allocations_sample
+        )
+        stored_std = _max_deviation_per_slice(stored).mean()
+        seeded_std = _max_deviation_per_slice(seeded).mean()
+        cold_std = _max_deviation_per_slice(cold).mean()
+        assert seeded_std < cold_std
+        assert seeded_std < stored_std * 1.25
+
+    def test_distribution_warm_start_as_tier(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            distributor = TieredDistributor(
+                max_deviation=0,
+                tiers=[
+                    RandomLoopDistributor(max_its=10, warm_start=WarmStartStore(path))
+                ],
+            )
+            distribution = distributor.distribute(master_sample, allocations_sample)
+            assert verify_distribution(distribution, master_sample)
+            assert len(WarmStartStore(path)) == len(distributor.report)
+
+    def test_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            store = WarmStartStore(path)
+            distributor = RandomLoopDistributor(max_its=10, warm_start=store)
+            distributor.distribute(master_sample, allocations_sample)
+            assert len(WarmStartStore(path, max_age_days=-1)) == 0
+
+    def test_unreadable_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            with open(path, 'w') as f:
+                f.write('{"version": 2, "entr')
+            with self.assertWarnsRegex(UserWarning, 'could not be read'):
+                store = WarmStartStore(path)
+            assert len(store) == 0
+
+            distributor = RandomLoopDistributor(max_its=10, warm_start=store)
+            distributor.distribute(master_sample, allocations_sample)
+            assert len(WarmStartStore(path)) > 0
+            assert os.listdir(tmp_dir) == ['warm_start.json']
+
+    def test_saved_once_per_distribute(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            distributor = RandomLoopDistributor(
+                max_its=10, warm_start=WarmStartStore(path)
+            )
+            slice = {'BROKER': 'XP', 'TICKER': 'PETR4', 'SIDE': 'C'}
+            distributor.distribute_slice(
+                [(100, 10.0), (200, 10.1)], [('P0', 150), ('P1', 150)], slice=slice
+            )
+            assert not os.path.exists(path)
+
+            distributor.flush()
+            assert len(WarmStartStore(path)) == 1
+
+    def test_file_mode_kept(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            store = WarmStartStore(path)
+            RandomLoopDistributor(max_its=10, warm_start=store).distribute(
+                master_sample, allocations_sample
+            )
+            umask = os.umask(0)
+            os.umask(umask)
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~umask
+
+            os.chmod(path, 0o640)
+            store = WarmStartStore(path)
+            RandomLoopDistributor(max_its=10, warm_start=store).distribute(
+                master_sample, allocations_sample
+            )
+            assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+
+    def test_n_quantiles_share_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'warm_start.json')
+            for n_quantiles in (10, 5):
+                store = WarmStartStore(path, n_quantiles=n_quantiles)
+                RandomLoopDistributor(max_its=10, warm_start=store).distribute(
+                    master_sample, allocations_sample
+                )
+            n_slices = master_sample.groupby(['BROKER', 'TICKER', 'SIDE']).ngroups
+            assert len(WarmStartStore(path)) == 2 * n_slices